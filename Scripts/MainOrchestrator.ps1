@@ -11,6 +11,20 @@ Write-Host "Starting Power BI PBIP Deployment..."
 Write-Host "Workspace: $Workspace"
 Write-Host "Config File: $ConfigFile"
 
+# Sql.Database("server", "database"[, options]) source used in partition M expressions.
+# Compiled once here; applied to every partition of every semantic model deployed.
+$script:SqlDatabaseRegex = [regex]::new('Sql\.Database\(".*?"\s*,\s*".*?"(?:\s*,\s*\[.*?\])?\)', 'Compiled, IgnoreCase')
+
+# Paths inside a .platform file or folder are excluded from report definition parts
+$script:PlatformPathRegex = [regex]::new('\\\.platform($|\\)', 'Compiled, IgnoreCase')
+
+# Access token shared across the run; Get-SPNToken refreshes it when fewer than 30 minutes remain,
+# enough headroom for one full Deploy-PBIPUsingFabricAPI call (including its polling) to finish.
+$script:TokenCache = $null
+
+# Workspaces whose access has already been verified during this run
+$script:VerifiedWorkspaces = @{}
+
 # ===============================
 # UTILITY FUNCTIONS
 # ===============================
@@ -26,6 +40,11 @@ function Get-SPNToken {
         [Parameter(Mandatory=$true)]
         [string]$ClientSecret
     )
+
+    if ($script:TokenCache -and $script:TokenCache.ClientId -eq $ClientId -and
+        $script:TokenCache.ExpiresOn -gt (Get-Date).AddMinutes(30)) {
+        return $script:TokenCache.AccessToken
+    }
     
     try {
         Write-Host "Acquiring access token for Fabric API..."
@@ -38,10 +57,8 @@ function Get-SPNToken {
         }
         
         $tokenResponse = Invoke-RestMethod -Uri "https://login.microsoftonline.com/$TenantId/oauth2/v2.0/token" -Method Post -Body $body
-        $accessToken = $tokenResponse.access_token
         
         Write-Host "✓ Successfully acquired Fabric API access token"
-        return $accessToken
     }
     catch {
         Write-Error "Failed to acquire access token for Fabric API: $_"
@@ -58,16 +75,72 @@ function Get-SPNToken {
             }
             
             $tokenResponse = Invoke-RestMethod -Uri "https://login.microsoftonline.com/$TenantId/oauth2/token" -Method Post -Body $body
-            $accessToken = $tokenResponse.access_token
             
             Write-Host "✓ Successfully acquired Power BI API access token as fallback"
-            return $accessToken
         }
         catch {
             Write-Error "Failed to acquire Power BI API access token: $_"
             throw "Could not acquire any access token"
         }
     }
+
+    $script:TokenCache = @{
+        AccessToken = $tokenResponse.access_token
+        ClientId    = $ClientId
+        ExpiresOn   = (Get-Date).AddSeconds([int]$tokenResponse.expires_in)
+    }
+    return $script:TokenCache.AccessToken
+}
+
+function Invoke-FabricRestMethod {
+    param(
+        [Parameter(Mandatory=$true)]
+        [string]$Uri,
+        [string]$Method = "Get",
+        [hashtable]$Headers,
+        $Body = $null,
+        [ref]$ResponseHeaders,      # Optional; receives the response headers (PowerShell 6+)
+        [int]$MaxRetries = 5
+    )
+
+    $requestParams = @{
+        Uri         = $Uri
+        Method      = $Method
+        Headers     = $Headers
+        ErrorAction = 'Stop'
+    }
+    if ($null -ne $Body) { $requestParams['Body'] = $Body }
+    if ($null -ne $ResponseHeaders -and $PSVersionTable.PSVersion.Major -ge 6) {
+        $requestParams['ResponseHeadersVariable'] = 'fabricResponseHeaders'
+    }
+
+    $attempt = 0
+    while ($true) {
+        try {
+            $result = Invoke-RestMethod @requestParams
+            if ($requestParams.ContainsKey('ResponseHeadersVariable')) { $ResponseHeaders.Value = $fabricResponseHeaders }
+            return $result
+        }
+        catch {
+            $statusCode = $null
+            try { $statusCode = $_.Exception.Response.StatusCode.Value__ } catch {}
+            if ($statusCode -ne 429 -or $attempt -ge $MaxRetries) { throw }
+
+            # Honour Retry-After when the service sends it, otherwise back off exponentially
+            $retryAfter = [math]::Pow(2, $attempt + 1)
+            try {
+                $headerValue = $_.Exception.Response.Headers.RetryAfter.Delta.TotalSeconds
+                if (-not $headerValue) { $headerValue = $_.Exception.Response.Headers['Retry-After'] }
+                if ($headerValue) { $retryAfter = [double]$headerValue }
+            } catch {}
+            # Never let a server-sent value stall the pipeline for long
+            $retryAfter = [math]::Min($retryAfter, 60)
+
+            $attempt++
+            Write-Warning "Throttled (429) on $Uri. Retrying in $retryAfter s (attempt $attempt/$MaxRetries)"
+            Start-Sleep -Seconds $retryAfter
+        }
+    }
 }
 
 function Get-PBIPFiles {
@@ -117,7 +190,9 @@ function Validate-PBIPStructure {
     $reportFolder = Join-Path $pbipDir "$baseName.Report"
     $semanticModelFolder = Join-Path $pbipDir "$baseName.SemanticModel"
     
-    $isValid = (Test-Path $reportFolder) -and (Test-Path $semanticModelFolder)
+    $hasReportFolder = Test-Path $reportFolder
+    $hasSemanticModelFolder = Test-Path $semanticModelFolder
+    $isValid = $hasReportFolder -and $hasSemanticModelFolder
     
     if ($isValid) {
         Write-Host "✓ PBIP structure validated for: $baseName"
@@ -137,8 +212,8 @@ function Validate-PBIPStructure {
         }
     } else {
         Write-Warning "Invalid PBIP structure for: $baseName"
-        Write-Warning "  Missing Report folder: $(-not (Test-Path $reportFolder))"
-        Write-Warning "  Missing SemanticModel folder: $(-not (Test-Path $semanticModelFolder))"
+        Write-Warning "  Missing Report folder: $(-not $hasReportFolder)"
+        Write-Warning "  Missing SemanticModel folder: $(-not $hasSemanticModelFolder)"
         
         return @{
             IsValid = $false
@@ -153,6 +228,11 @@ function Verify-WorkspaceAccess {
         [Parameter(Mandatory=$true)]
         [string]$AccessToken
     )
+
+    if ($script:VerifiedWorkspaces.ContainsKey($WorkspaceId)) {
+        Write-Host "✓ Workspace access already verified: $($script:VerifiedWorkspaces[$WorkspaceId])"
+        return $true
+    }
     
     try {
         Write-Host "Verifying access to workspace: $WorkspaceId"
@@ -163,9 +243,10 @@ function Verify-WorkspaceAccess {
         }
         
         $uri = "https://api.fabric.microsoft.com/v1/workspaces/$WorkspaceId"
-        $response = Invoke-RestMethod -Uri $uri -Method Get -Headers $headers
+        $response = Invoke-FabricRestMethod -Uri $uri -Method Get -Headers $headers
         
         Write-Host "✓ Workspace access verified: $($response.displayName)"
+        $script:VerifiedWorkspaces[$WorkspaceId] = $response.displayName
         return $true
     }
     catch {
@@ -180,7 +261,9 @@ function Wait-FabricOperationCompletion {
         [string]$OperationStatusUrl,
         [Parameter(Mandatory=$true)]
         [string]$AccessToken,
-        [int]$MaxWaitSeconds = 180
+        [int]$MaxWaitSeconds = 180,
+        # Receives the final operation status ('TimedOut' when the wait runs out)
+        [ref]$FinalStatus
     )
 
     $headers = @{
@@ -188,25 +271,34 @@ function Wait-FabricOperationCompletion {
         "Content-Type" = "application/json"
     }
 
-    $elapsed = 0
+    # Wall-clock timer, so request time and 429 retries count against the budget too
+    $timer = [System.Diagnostics.Stopwatch]::StartNew()
     $interval = 5
-    while ($elapsed -lt $MaxWaitSeconds) {
+    if ($FinalStatus) { $FinalStatus.Value = $null }
+    while ($timer.Elapsed.TotalSeconds -lt $MaxWaitSeconds) {
+        # Only the REST call is guarded; a terminal status must end the wait, not be retried
+        $status = $null
         try {
-            $resp = Invoke-RestMethod -Uri $OperationStatusUrl -Method Get -Headers $headers -ErrorAction Stop
+            $resp = Invoke-FabricRestMethod -Uri $OperationStatusUrl -Method Get -Headers $headers
             $status = $resp.status
             if (-not $status) { $status = $resp.state }
-            if ($status -and ($status -in @('Succeeded','Completed'))) { return $true }
-            if ($status -and ($status -in @('Failed','Error'))) {
-                Write-Error "Fabric operation failed: $($resp | ConvertTo-Json -Depth 10)"
-                return $false
-            }
         } catch {
             Write-Warning "Failed to poll operation status: $($_.Exception.Message)"
         }
-        Start-Sleep -Seconds $interval
-        $elapsed += $interval
+        if ($FinalStatus -and $status) { $FinalStatus.Value = $status }
+        if ($status -and ($status -in @('Succeeded','Completed'))) { return $true }
+        if ($status -and ($status -in @('Failed','Error'))) {
+            Write-Warning "Fabric operation failed: $($resp | ConvertTo-Json -Depth 10)"
+            return $false
+        }
+        $remaining = $MaxWaitSeconds - $timer.Elapsed.TotalSeconds
+        if ($remaining -le 0) { break }
+        Start-Sleep -Seconds ([int][math]::Ceiling([math]::Min($interval, $remaining)))
     }
     Write-Warning "Operation did not complete within $MaxWaitSeconds seconds"
+    if ($FinalStatus -and $FinalStatus.Value -notin @('Succeeded','Completed','Failed','Error')) {
+        $FinalStatus.Value = 'TimedOut'
+    }
     return $false
 }
 
@@ -225,7 +317,7 @@ function List-WorkspaceItems {
         }
         
         $uri = "https://api.fabric.microsoft.com/v1/workspaces/$WorkspaceId/items"
-        $response = Invoke-RestMethod -Uri $uri -Method Get -Headers $headers
+        $response = Invoke-FabricRestMethod -Uri $uri -Method Get -Headers $headers
         
         Write-Host "Workspace items found: $($response.value.Count)"
         foreach ($item in $response.value) {
@@ -271,7 +363,7 @@ function Debug-PBIPContent {
             $modelFiles = Get-ChildItem $semanticModelFolder -Recurse
             Write-Host "  - Semantic model files: $($modelFiles.Count)"
             
-            $modelBim = Get-ChildItem $semanticModelFolder -Filter "model.bim" -Recurse
+            $modelBim = $modelFiles | Where-Object { $_.Name -eq "model.bim" } | Select-Object -First 1
             if ($modelBim) {
                 $modelSize = [math]::Round($modelBim.Length / 1KB, 2)
                 Write-Host "  - Model.bim size: $modelSize KB"
@@ -293,12 +385,17 @@ function Wait-ForDeploymentCompletion {
         [string]$ItemName,
         [Parameter(Mandatory=$true)]
         [string]$ItemType,   # "Report" or "SemanticModel"
-        [int]$MaxWaitMinutes = 5
+        [int]$MaxWaitMinutes = 5,
+        # Overrides MaxWaitMinutes when a caller has a budget in seconds
+        [int]$MaxWaitSeconds = -1
     )
     
-    $maxWaitTime = $MaxWaitMinutes * 60
+    $maxWaitTime = if ($MaxWaitSeconds -ge 0) { $MaxWaitSeconds } else { $MaxWaitMinutes * 60 }
+    # Wall-clock timer, so request time and 429 retries count against the budget too
+    $timer = [System.Diagnostics.Stopwatch]::StartNew()
     $waitTime = 0
-    $checkInterval = 15
+    $checkInterval = 2
+    $maxCheckInterval = 15
     
     Write-Host "⏳ Waiting for $ItemType '$ItemName' to appear in workspace..."
     
@@ -306,19 +403,17 @@ function Wait-ForDeploymentCompletion {
         "Authorization" = "Bearer $AccessToken"
         "Content-Type"  = "application/json"
     }
+    # Always use unified items endpoint in Fabric, narrowed server-side to the item type
+    $uri = "https://api.fabric.microsoft.com/v1/workspaces/$WorkspaceId/items?type=$ItemType"
     
-    do {
-        Start-Sleep -Seconds $checkInterval
-        $waitTime += $checkInterval
-        
+    # Check straight away, then back off exponentially up to $maxCheckInterval
+    while ($true) {
         try {
-            # Always use unified items endpoint in Fabric
-            $uri = "https://api.fabric.microsoft.com/v1/workspaces/$WorkspaceId/items"
-            $response = Invoke-RestMethod -Uri $uri -Method Get -Headers $headers -ErrorAction Stop
+            $response = Invoke-FabricRestMethod -Uri $uri -Method Get -Headers $headers
             
-            $item = $response.value | Where-Object { 
+            $item = @($response.value).Where({ 
                 $_.displayName -eq $ItemName -and $_.type -eq $ItemType 
-            }
+            }, 'First')[0]
             
             if ($item) {
                 if ($item.state -and $item.state -ne "Active") {
@@ -326,7 +421,7 @@ function Wait-ForDeploymentCompletion {
                 }
                 else {
                     Write-Host "✅ $ItemType '$ItemName' is ready in workspace"
-                    return $true
+                    return $item
                 }
             }
             else {
@@ -337,9 +432,15 @@ function Wait-ForDeploymentCompletion {
             Write-Warning "Error checking for item: $($_.Exception.Message)"
         }
         
-    } while ($waitTime -lt $maxWaitTime)
+        $remaining = $maxWaitTime - $timer.Elapsed.TotalSeconds
+        if ($remaining -le 0) { break }
+        # Clamp the last sleep so the backoff never overshoots the deadline
+        Start-Sleep -Seconds ([int][math]::Ceiling([math]::Min($checkInterval, $remaining)))
+        $waitTime = [int]$timer.Elapsed.TotalSeconds
+        $checkInterval = [math]::Min($checkInterval * 2, $maxCheckInterval)
+    }
     
-    Write-Warning "❌ $ItemType '$ItemName' not found after $MaxWaitMinutes minutes"
+    Write-Warning "❌ $ItemType '$ItemName' not found after $maxWaitTime seconds"
     return $false
 }
 
@@ -364,16 +465,19 @@ function Verify-DeploymentResult {
         
         # Get all workspace items
         $uri = "https://api.fabric.microsoft.com/v1/workspaces/$WorkspaceId/items"
-        $response = Invoke-RestMethod -Uri $uri -Method Get -Headers $headers
+        $response = Invoke-FabricRestMethod -Uri $uri -Method Get -Headers $headers
         
-        # Check for semantic model
-        $semanticModel = $response.value | Where-Object { 
-            $_.displayName -eq $SemanticModelName -and $_.type -eq "SemanticModel" 
-        }
-        
-        # Check for report
-        $report = $response.value | Where-Object { 
-            $_.displayName -eq $ReportName -and $_.type -eq "Report" 
+        # Check for semantic model and report in a single pass over the items
+        $semanticModel = $null
+        $report = $null
+        foreach ($item in $response.value) {
+            if (-not $semanticModel -and $item.type -eq "SemanticModel" -and $item.displayName -eq $SemanticModelName) {
+                $semanticModel = $item
+            }
+            elseif (-not $report -and $item.type -eq "Report" -and $item.displayName -eq $ReportName) {
+                $report = $item
+            }
+            if ($semanticModel -and $report) { break }
         }
         
         return @{
@@ -381,6 +485,7 @@ function Verify-DeploymentResult {
             ReportFound = ($report -ne $null)
             SemanticModelId = if ($semanticModel) { $semanticModel.id } else { $null }
             ReportId = if ($report) { $report.id } else { $null }
+            Items = $response.value
         }
     }
     catch {
@@ -390,6 +495,7 @@ function Verify-DeploymentResult {
             ReportFound = $false
             SemanticModelId = $null
             ReportId = $null
+            Items = $null
         }
     }
 }
@@ -407,7 +513,8 @@ function Deploy-SemanticModel {
         [Parameter(Mandatory=$true)]
         [string]$ServerName,
         [Parameter(Mandatory=$true)]
-        [string]$DatabaseName
+        [string]$DatabaseName,
+        [string]$ModelBimPath = $null   # Path already resolved by Validate-PBIPStructure, if any
     )
     $deployedModelId   = $null
     $deployedModelName = $null
@@ -415,65 +522,78 @@ function Deploy-SemanticModel {
     try {
         Write-Host "Deploying semantic model: $ModelName"
 
-        $modelBimFile = Get-ChildItem -Path $SemanticModelFolder -Filter "model.bim" -Recurse | Select-Object -First 1
+        if ($ModelBimPath -and (Test-Path $ModelBimPath)) {
+            $modelBimFile = Get-Item $ModelBimPath
+        } else {
+            $modelBimFile = Get-ChildItem -Path $SemanticModelFolder -Filter "model.bim" -Recurse | Select-Object -First 1
+        }
         if (-not $modelBimFile) { throw "model.bim file not found in semantic model folder" }
 
         $modelDefinitionRaw = Get-Content $modelBimFile.FullName -Raw
-        $modelJson = $modelDefinitionRaw | ConvertFrom-Json
-
-        # Connection switching
-        $pattern = 'Sql\.Database\(".*?"\s*,\s*".*?"(?:\s*,\s*\[.*?\])?\)'
-        $replacement = 'Sql.Database("' + $ServerName + '", "' + $DatabaseName + '")'
-        $updatesApplied = 0
-
-        foreach ($table in $modelJson.model.tables) {
-            foreach ($partition in $table.partitions) {
-                if ($partition.source -and $partition.source.type -eq 'm' -and $partition.source.expression) {
-                    if ($partition.source.expression -is [System.Array]) {
-                        $partition.source.expression = $partition.source.expression | ForEach-Object { $_ -replace $pattern, $replacement }
-                        $updatesApplied++
-                    } elseif ($partition.source.expression -is [string]) {
-                        $partition.source.expression = $partition.source.expression -replace $pattern, $replacement
-                        $updatesApplied++
+
+        # Only parse and re-serialize the model when it has a Sql.Database source to switch;
+        # otherwise upload model.bim exactly as read.
+        if ($modelDefinitionRaw.IndexOf('Sql.Database(', [System.StringComparison]::OrdinalIgnoreCase) -ge 0) {
+            $modelJson = $modelDefinitionRaw | ConvertFrom-Json
+
+            # Connection switching
+            $replacement = 'Sql.Database("' + $ServerName + '", "' + $DatabaseName + '")'
+            $updatesApplied = 0
+
+            foreach ($table in $modelJson.model.tables) {
+                foreach ($partition in $table.partitions) {
+                    if ($partition.source -and $partition.source.type -eq 'm' -and $partition.source.expression) {
+                        if ($partition.source.expression -is [System.Array]) {
+                            $partition.source.expression = @(foreach ($line in $partition.source.expression) { $script:SqlDatabaseRegex.Replace($line, $replacement) })
+                            $updatesApplied++
+                        } elseif ($partition.source.expression -is [string]) {
+                            $partition.source.expression = $script:SqlDatabaseRegex.Replace($partition.source.expression, $replacement)
+                            $updatesApplied++
+                        }
                     }
                 }
             }
-        }
 
-        if ($updatesApplied -gt 0) {
-            Write-Host "✓ Connection switching applied to $updatesApplied partition(s)"
-        }
+            if ($updatesApplied -gt 0) {
+                Write-Host "✓ Connection switching applied to $updatesApplied partition(s)"
+            }
 
-        $modelDefinition = $modelJson | ConvertTo-Json -Depth 100
+            $modelDefinition = $modelJson | ConvertTo-Json -Depth 100
+        }
+        else {
+            Write-Host "No Sql.Database source found → skipping connection switching"
+            $modelDefinition = $modelDefinitionRaw
+        }
 
         # Build parts
-        $smParts = @()
         $smDir = Split-Path $modelBimFile.FullName -Parent
-        $smParts += @{
-            path = 'model.bim'
-            payload = [Convert]::ToBase64String([System.Text.Encoding]::UTF8.GetBytes($modelDefinition))
-            payloadType = 'InlineBase64'
-        }
-        foreach ($optional in @('diagramLayout.json','definition.pbism')) {
-            $optPath = Join-Path $smDir $optional
-            if (Test-Path $optPath) {
-                $bytes = [System.IO.File]::ReadAllBytes($optPath)
-                $smParts += @{ path = $optional; payload = [Convert]::ToBase64String($bytes); payloadType = 'InlineBase64' }
+        $smParts = @(
+            @{
+                path = 'model.bim'
+                payload = [Convert]::ToBase64String([System.Text.Encoding]::UTF8.GetBytes($modelDefinition))
+                payloadType = 'InlineBase64'
             }
-        }
+            foreach ($optional in @('diagramLayout.json','definition.pbism')) {
+                $optPath = Join-Path $smDir $optional
+                if (Test-Path $optPath) {
+                    $bytes = [System.IO.File]::ReadAllBytes($optPath)
+                    @{ path = $optional; payload = [Convert]::ToBase64String($bytes); payloadType = 'InlineBase64' }
+                }
+            }
+        )
 
         $headers = @{ "Authorization" = "Bearer $AccessToken"; "Content-Type" = "application/json" }
 
         # 🔑 Step 1: Check if model exists already
         $listUrl = "https://api.fabric.microsoft.com/v1/workspaces/$WorkspaceId/semanticModels"
-        $listResponse = Invoke-RestMethod -Uri $listUrl -Method Get -Headers $headers
-        $existingModel = $listResponse.value | Where-Object { $_.displayName -eq $ModelName } | Select-Object -First 1
+        $listResponse = Invoke-FabricRestMethod -Uri $listUrl -Method Get -Headers $headers
+        $existingModel = @($listResponse.value).Where({ $_.displayName -eq $ModelName }, 'First')[0]
 
         if ($existingModel) {
             Write-Host "Semantic model already exists (ID: $($existingModel.id)) → updating definition..."
             $updateUrl = "https://api.fabric.microsoft.com/v1/workspaces/$WorkspaceId/semanticModels/$($existingModel.id)/updateDefinition"
             $updatePayload = @{ definition = @{ parts = $smParts } } | ConvertTo-Json -Depth 50
-            Invoke-RestMethod -Uri $updateUrl -Method Post -Body $updatePayload -Headers $headers
+            Invoke-FabricRestMethod -Uri $updateUrl -Method Post -Body $updatePayload -Headers $headers
             Write-Host "✓ Semantic model updated successfully"
             $deployedModelId = $existingModel.id
             $deployedModelName = $existingModel.displayName
@@ -488,7 +608,7 @@ function Deploy-SemanticModel {
             } | ConvertTo-Json -Depth 50
 
             $deployUrl = "https://api.fabric.microsoft.com/v1/workspaces/$WorkspaceId/semanticModels"
-            $createResp = Invoke-RestMethod -Uri $deployUrl -Method Post -Body $deploymentPayload -Headers $headers
+            $createResp = Invoke-FabricRestMethod -Uri $deployUrl -Method Post -Body $deploymentPayload -Headers $headers
             Write-Host "✓ Semantic model created successfully (ID: $($createResp.id))"
             $deployedModelId =  $createResp.id 
             $deployedModelName = $createResp.displayName 
@@ -569,9 +689,8 @@ function Deploy-Report {
             }
             else {
                 # Case C: discover a *.Report folder anywhere beneath ReportFolder
-                $found = Get-ChildItem -Path $ReportFolder -Directory -Recurse -ErrorAction SilentlyContinue |
+                $found = Get-ChildItem -Path $ReportFolder -Directory -Recurse -Filter '*.Report' -ErrorAction SilentlyContinue |
                     Where-Object {
-                        $_.Name -like '*.Report' -and
                         (Test-Path (Join-Path $_.FullName 'report.json') -ErrorAction SilentlyContinue) -and
                         (Test-Path (Join-Path $_.FullName 'definition.pbir') -ErrorAction SilentlyContinue)
                     } |
@@ -587,59 +706,52 @@ function Deploy-Report {
 
         $reportFolderPath = [System.IO.Path]::GetFullPath($reportFolderPath)
         Write-Host "📁 Using report folder: $reportFolderPath"
-        # ---------- Validate ----------
-        $reportJsonFile = Join-Path $reportFolderPath "report.json"
-        if (-not (Test-Path $reportJsonFile)) { throw "❌ report.json not found in $reportFolderPath" }
+        # report.json and definition.pbir were both verified while resolving the folder above
 
         # --- Force bind definition.pbir to semanticModelId ---
         $defPath = Join-Path $reportFolderPath 'definition.pbir'
+        Write-Host "🔗 Forcing definition.pbir to bind report → semanticModelId $SemanticModelId"
 
-        if (Test-Path $defPath) {
-            Write-Host "🔗 Forcing definition.pbir to bind report → semanticModelId $SemanticModelId"
-
-            # Load and overwrite datasetReference
-            $def = Get-Content $defPath -Raw | ConvertFrom-Json
-            $def.datasetReference = @{
-                byConnection = @{
-                    connectionString = "semanticmodelid=$SemanticModelId"
-                }
+        # Load and overwrite datasetReference
+        $def = Get-Content $defPath -Raw | ConvertFrom-Json
+        $def.datasetReference = @{
+            byConnection = @{
+                connectionString = "semanticmodelid=$SemanticModelId"
             }
+        }
 
-            # Write back to file
-            $jsonOut = $def | ConvertTo-Json -Depth 50
-            $jsonOut | Set-Content $defPath -Encoding UTF8
+        # Keep the rebound definition in memory; it replaces the on-disk copy in the parts below
+        $jsonOut = $def | ConvertTo-Json -Depth 50
+        $defPayload = [Convert]::ToBase64String([System.Text.Encoding]::UTF8.GetBytes($jsonOut))
 
-            Write-Host "✅ Updated definition.pbir:"
-            Write-Host $jsonOut
-        }
-        else {
-            Write-Warning "⚠️ No definition.pbir found in $reportFolderPath"
-        }
+        Write-Host "✅ Updated definition.pbir:"
+        Write-Host $jsonOut
 
 
         # ---------- Build parts from .Report only ----------
+        $hiddenOrSystem = [IO.FileAttributes]::Hidden -bor [IO.FileAttributes]::System
         $allFiles = Get-ChildItem -Path $reportFolderPath -Recurse -File -Force |
             Where-Object { 
                 # Exclude .platform and hidden/system files
-                $_.FullName -notmatch '\\\.platform($|\\)' -and
-                -not $_.Attributes.HasFlag([IO.FileAttributes]::Hidden) -and
-                -not $_.Attributes.HasFlag([IO.FileAttributes]::System)
+                -not $script:PlatformPathRegex.IsMatch($_.FullName) -and
+                ($_.Attributes -band $hiddenOrSystem) -eq 0
             }
 
-            $parts = @()
-
-            foreach ($file in $allFiles) {
-                $rel = $file.FullName.Substring($reportFolderPath.Length).TrimStart('\','/')
-                $rel = $rel -replace '\\','/'
+            $parts = @(foreach ($file in $allFiles) {
+                $rel = $file.FullName.Substring($reportFolderPath.Length).TrimStart('\','/').Replace('\','/')
 
-                $b64 = [Convert]::ToBase64String([System.IO.File]::ReadAllBytes($file.FullName))
+                if ($rel -eq 'definition.pbir') {
+                    $b64 = $defPayload
+                } else {
+                    $b64 = [Convert]::ToBase64String([System.IO.File]::ReadAllBytes($file.FullName))
+                }
 
-                $parts += @{
+                @{
                     path        = $rel
                     payload     = $b64
                     payloadType = 'InlineBase64'
                 }
-            }
+            })
 
         Write-Host "✓ Collected $($parts.Count) parts from .Report"
         $parts | Select-Object -First 5 | ForEach-Object { Write-Host "   - $($_.path)" }
@@ -664,36 +776,48 @@ function Deploy-Report {
             "Content-Type" = "application/json"
         }
         $createUrl = "https://api.fabric.microsoft.com/v1/workspaces/$WorkspaceId/items"
+        $filterName = $ReportName.Replace("'", "''")
+        $listUrl = "https://api.fabric.microsoft.com/v1/workspaces/$WorkspaceId/items?`$filter=displayName eq '$filterName' and type eq 'Report'"
 
         # ---------- Create ----------
         try {
-            $response = Invoke-RestMethod -Uri $createUrl -Method Post -Headers $headers -Body $deploymentPayloadJson -ErrorAction Stop
+            # One budget for the report to become available, shared by the operation wait and the listing poll
+            $timeoutSeconds = 300
+            $startedAt = Get-Date
+            $deadline = $startedAt.AddSeconds($timeoutSeconds)
+            $createHeaders = $null
+            $response = Invoke-FabricRestMethod -Uri $createUrl -Method Post -Headers $headers -Body $deploymentPayloadJson -ResponseHeaders ([ref]$createHeaders)
 
             $reportId = $null
             if ($null -ne $response -and $response.id) { $reportId = $response.id }
-            if (-not $reportId) { Write-Host "ℹ️ No immediate body; polling for availability..." }
-
-            # Poll for visibility
-            $filterName = $ReportName.Replace("'", "''")
-            $listUrl = "https://api.fabric.microsoft.com/v1/workspaces/$WorkspaceId/items?`$filter=displayName eq '$filterName' and type eq 'Report'"
-            $timeoutSeconds = 300
-            $intervalSeconds = 15
-            $elapsed = 0
 
-            while ($elapsed -lt $timeoutSeconds -and -not $reportId) {
+            # 202 Accepted: follow the long-running operation rather than polling the item list blind
+            $operationUrl = if ($createHeaders -and $createHeaders['Location']) { @($createHeaders['Location'])[0] } else { $null }
+            if (-not $reportId -and $operationUrl) {
+                Write-Host "ℹ️ Creation accepted; waiting on operation: $operationUrl"
+                $operationStatus = $null
+                $remainingSeconds = [int][math]::Max(0, ($deadline - (Get-Date)).TotalSeconds)
+                if (-not (Wait-FabricOperationCompletion -OperationStatusUrl $operationUrl -AccessToken $AccessToken -MaxWaitSeconds $remainingSeconds -FinalStatus ([ref]$operationStatus))) {
+                    throw "❌ Report creation operation did not succeed. Status: $operationStatus"
+                }
                 try {
-                    $listResponse = Invoke-RestMethod -Uri $listUrl -Method Get -Headers $headers
-                    $existingReport = $listResponse.value | Select-Object -First 1
-                    if ($existingReport -and $existingReport.id) { $reportId = $existingReport.id; break }
+                    $operationResult = Invoke-FabricRestMethod -Uri "$operationUrl/result" -Method Get -Headers $headers
+                    if ($operationResult -and $operationResult.id) { $reportId = $operationResult.id }
                 }
-                catch { Write-Warning "Polling error: $($_.Exception.Message)" }
-
-                Write-Host "⏳ Waiting $intervalSeconds s..."
-                Start-Sleep -Seconds $intervalSeconds
-                $elapsed += $intervalSeconds
+                catch { Write-Warning "Could not read operation result: $($_.Exception.Message)" }
+            }
+            # Listing poll only when there was no operation to follow or its result could not be read
+            if (-not $reportId) {
+                Write-Host "ℹ️ No immediate body; polling for availability..."
+                $remainingSeconds = [int][math]::Max(0, ($deadline - (Get-Date)).TotalSeconds)
+                $readyReport = Wait-ForDeploymentCompletion -WorkspaceId $WorkspaceId -AccessToken $AccessToken -ItemName $ReportName -ItemType "Report" -MaxWaitSeconds $remainingSeconds
+                if ($readyReport) { $reportId = $readyReport.id }
             }
 
-            if (-not $reportId) { throw "❌ Report did not become available within $timeoutSeconds seconds." }
+            if (-not $reportId) {
+                $waitedSeconds = [int]((Get-Date) - $startedAt).TotalSeconds
+                throw "❌ Report did not become available after $waitedSeconds seconds (budget: $timeoutSeconds seconds)."
+            }
 
             Write-Host "✅ Report deployed successfully. Report ID: $reportId"
             return $reportId
@@ -706,9 +830,7 @@ function Deploy-Report {
             if ($statusCode -eq 409) {
                 Write-Host "⚠️ Report already exists. Updating definition..."
 
-                $filterName = $ReportName.Replace("'", "''")
-                $listUrl = "https://api.fabric.microsoft.com/v1/workspaces/$WorkspaceId/items?`$filter=displayName eq '$filterName' and type eq 'Report'"
-                $listResponse = Invoke-RestMethod -Uri $listUrl -Method Get -Headers $headers
+                $listResponse = Invoke-FabricRestMethod -Uri $listUrl -Method Get -Headers $headers
                 $existingReport = $listResponse.value | Select-Object -First 1
 
                 if ($existingReport) {
@@ -722,7 +844,7 @@ function Deploy-Report {
                     if ($SemanticModelId) { $updatePayload["semanticModelId"] = $SemanticModelId }
 
                     $updatePayloadJson = $updatePayload | ConvertTo-Json -Depth 50
-                    Invoke-RestMethod -Uri $updateUrl -Method Post -Body $updatePayloadJson -Headers $headers -ErrorAction Stop
+                    Invoke-FabricRestMethod -Uri $updateUrl -Method Post -Body $updatePayloadJson -Headers $headers
                     Write-Host "✅ Report updated successfully"
                     return $existingReport.id
                 }
@@ -787,7 +909,7 @@ function Deploy-PBIPUsingFabricAPI {
         
         # Step 4: Deploy Semantic Model
         Write-Host "`n--- STEP 4: SEMANTIC MODEL DEPLOYMENT ---"
-        $semanticModelResult = Deploy-SemanticModel -SemanticModelFolder $validation.SemanticModelFolder -WorkspaceId $WorkspaceId -AccessToken $AccessToken -ModelName $ReportName -ServerName $ServerName -DatabaseName $DatabaseName
+        $semanticModelResult = Deploy-SemanticModel -SemanticModelFolder $validation.SemanticModelFolder -WorkspaceId $WorkspaceId -AccessToken $AccessToken -ModelName $ReportName -ServerName $ServerName -DatabaseName $DatabaseName -ModelBimPath $validation.ModelBimFile
         
         if (-not $semanticModelResult.Success) {
             throw "Semantic model deployment failed: $($semanticModelResult.Error)"
@@ -814,8 +936,6 @@ function Deploy-PBIPUsingFabricAPI {
         
         if (-not $reportSuccess) {
             throw "Report deployment failed"
-        }else{
-            Start-Sleep -Seconds 30 # wait a bit before verification
         }
         
         # Step 7: Wait for report to appear
@@ -826,9 +946,18 @@ function Deploy-PBIPUsingFabricAPI {
         Write-Host "`n--- STEP 8: FINAL VERIFICATION ---"
         $verificationResult = Verify-DeploymentResult -WorkspaceId $WorkspaceId -AccessToken $AccessToken -ReportName $ReportName -SemanticModelName $ReportName
         
-        # Step 9: Post-deployment inventory
+        # Step 9: Post-deployment inventory (reuses the listing from step 8 when available)
         Write-Host "`n--- STEP 9: POST-DEPLOYMENT INVENTORY ---"
-        $postDeploymentItems = List-WorkspaceItems -WorkspaceId $WorkspaceId -AccessToken $AccessToken
+        $postDeploymentItems = $verificationResult.Items
+        if ($null -eq $postDeploymentItems) {
+            $postDeploymentItems = List-WorkspaceItems -WorkspaceId $WorkspaceId -AccessToken $AccessToken
+        }
+        else {
+            # Keep the per-item inventory List-WorkspaceItems used to write
+            foreach ($item in $postDeploymentItems) {
+                Write-Host "  - $($item.displayName) ($($item.type))"
+            }
+        }
         Write-Host "Post-deployment: Found $($postDeploymentItems.Count) items in workspace"
         
         $newItems = $postDeploymentItems.Count - $preDeploymentItems.Count
@@ -914,15 +1043,19 @@ try {
     Write-Host "Using Tenant ID: $tenantId"
     Write-Host "Using Client ID: $clientId"
 
-    # Map workspace based on environment
+    # Map workspace and warehouse connection based on environment
     $targetWorkspaceId = $null
     
     switch ($Workspace.ToUpper()) {
         "DEV" {
             $targetWorkspaceId = $config.DevWorkspaceID
+            $serverName = $config.DevWarehouseConnection
+            $databaseName = $config.DevWarehouseName
         }
         "PROD" {
             $targetWorkspaceId = $config.ProdWorkspaceID
+            $serverName = $config.ProdWarehouseConnection
+            $databaseName = $config.ProdWarehouseName
         }
         default {
             throw "Unsupported environment: $Workspace. Only DEV and PROD are supported."
@@ -954,16 +1087,15 @@ try {
     # Search for PBIP files
     Write-Host "Searching for PBIP files..."
     $reportFolders = @("Demo Report", "Reporting", "Reports", "PowerBI", "BI")
-    $allPbipFiles = @()
     
-    foreach ($folder in $reportFolders) {
+    $allPbipFiles = @(foreach ($folder in $reportFolders) {
         $folderPath = Join-Path $artifactPath $folder
         if (Test-Path $folderPath) {
             $pbipFiles = Get-PBIPFiles -ArtifactPath $artifactPath -Folder $folder
-            $allPbipFiles += $pbipFiles
             Write-Host "Found $($pbipFiles.Count) PBIP files in $folder folder"
+            $pbipFiles
         }
-    }
+    })
 
     # If no PBIP files found in specific folders, search entire repository
     if ($allPbipFiles.Count -eq 0) {
@@ -977,23 +1109,17 @@ try {
     }
 
     Write-Host "`n=== PBIP DEPLOYMENT ==="
-    $deploymentResults = @()
+    $deploymentResults = [System.Collections.Generic.List[object]]::new()
     
     foreach ($pbipFile in $allPbipFiles) {
         $reportName = [System.IO.Path]::GetFileNameWithoutExtension($pbipFile.Name)
         Write-Host "`nProcessing PBIP: $reportName"
         Write-Host "File path: $($pbipFile.FullName)"
-
-        # Determine connection settings based on target environment
-        if ($Workspace.ToUpper() -eq 'DEV') {
-            $serverName = $config.DevWarehouseConnection
-            $databaseName = $config.DevWarehouseName
-        } else {
-            $serverName = $config.ProdWarehouseConnection
-            $databaseName = $config.ProdWarehouseName
-        }
         Write-Host "Using connection -> Server: $serverName | Database: $databaseName"
 
+        # Served from cache unless the token could expire before this deployment's polling finishes
+        $accessToken = Get-SPNToken -TenantId $tenantId -ClientId $clientId -ClientSecret $clientSecret
+
         $deploymentSuccess = Deploy-PBIPUsingFabricAPI -PBIPFilePath $pbipFile.FullName -ReportName $reportName -WorkspaceId $targetWorkspaceId -AccessToken $accessToken -ServerName $serverName -DatabaseName $databaseName
         
         $result = [PSCustomObject]@{
@@ -1005,7 +1131,7 @@ try {
             WorkspaceId = $targetWorkspaceId
         }
         
-        $deploymentResults += $result
+        $deploymentResults.Add($result)
         
         if ($deploymentSuccess) {
             Write-Host "✓ Successfully deployed: $reportName"